@@ -1,7 +1,8 @@
 # scripts/dashboard_northwind.py
 # =====================================
 # Dashboard BI Northwind – Streamlit
-#   - Lit les CSV du DWH (data/processed)
+#   - Lit la table star.parquet du DWH (data/processed),
+#     ou à défaut les CSV du schéma en étoile
 #   - Filtres interactifs
 #   - Indicateurs clés
 #   - Graphiques Plotly
@@ -9,25 +10,112 @@
 # =====================================
 
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+import pyarrow.parquet as pq
 import streamlit as st
 import plotly.express as px
 
+from northwind_common import CUBES, STAR_FILE
+
 # ---------- Paths ----------
 BASE_DIR = Path(__file__).resolve().parents[1]
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
-DATA_FILES = [
-    "dim_time.csv",
-    "dim_customer.csv",
-    "dim_employee.csv",
-    "dim_shipper.csv",
-    "fact_sales.csv",
+TABLES = ["dim_time", "dim_customer", "dim_employee", "dim_shipper", "fact_sales"]
+DATA_FILES = [STAR_FILE]
+DATA_FILES += [f"{name}.{ext}" for name in TABLES for ext in ("parquet", "csv")]
+# Cubes pré-agrégés par l'ETL (spécification CUBES dans northwind_common)
+DATA_FILES += [f"{name}.parquet" for name in CUBES]
+
+# Colonnes de la table analytique effectivement utilisées par le dashboard
+USED_COLS = [
+    "OrderKey",
+    "CustomerKey",
+    "date",
+    "year",
+    "month",
+    "CustomerName",
+    "CustomerCountry",
+    "EmployeeFullName",
+    "ShipperName",
+    "DetailCount",
+    "TotalQuantity",
+    "AverageDiscount",
+    "TotalLineTotal",
+    "Freight",
+]
+
+# Colonnes du tableau de détail (et de son export CSV)
+DISPLAY_COLS = [
+    "OrderKey",
+    "date",
+    "CustomerName",
+    "CustomerCountry",
+    "EmployeeFullName",
+    "ShipperName",
+    "DetailCount",
+    "TotalQuantity",
+    "AverageDiscount",
+    "Freight",
+    "TotalLineTotal",
 ]
 
+# Clés de groupby / filtres : passées en category (codes entiers à hasher)
+CATEGORY_COLS = ["CustomerCountry", "CustomerName", "EmployeeFullName", "ShipperName"]
+
+# Schémas Arrow explicites : plus d'inférence de types à la lecture.
+# Les libellés répétés sont encodés en dictionnaire (→ category pandas).
+_LABEL = pa.dictionary(pa.int32(), pa.string())
+SCHEMAS = {
+    "dim_time": {
+        "TimeKey": pa.int64(),
+        "date": pa.timestamp("ns"),
+        "year": pa.int64(),
+        "month": pa.int64(),
+        "day": pa.int64(),
+    },
+    "dim_customer": {
+        "CustomerKey": pa.string(),
+        "CustomerName": pa.string(),
+        "CustomerCity": _LABEL,
+        "CustomerCountry": _LABEL,
+        "Phone": pa.string(),
+    },
+    "dim_employee": {
+        "EmployeeKey": pa.float64(),
+        "EmployeeFullName": _LABEL,
+        "FirstName": pa.string(),
+        "LastName": pa.string(),
+        "Title": _LABEL,
+        "City": _LABEL,
+        "Country": _LABEL,
+    },
+    "dim_shipper": {
+        "ShipperKey": pa.float64(),
+        "ShipperName": _LABEL,
+        "Phone": pa.string(),
+    },
+    "fact_sales": {
+        "OrderKey": pa.int64(),
+        "TimeKey": pa.int64(),
+        "CustomerKey": pa.string(),
+        "EmployeeKey": pa.float64(),
+        "ShipperKey": pa.float64(),
+        "DetailCount": pa.int64(),
+        "TotalQuantity": pa.float64(),
+        "AverageDiscount": pa.float64(),
+        "TotalLineTotal": pa.float64(),
+        "Freight": pa.float64(),
+    },
+}
+
 
 # ---------- Chargement DWH ----------
 def _processed_signature():
-    """Fingerprints des CSV pour invalider correctement le cache."""
+    """Fingerprints des fichiers DWH pour invalider correctement le cache."""
     signature = []
     for name in DATA_FILES:
         path = PROCESSED_DIR / name
@@ -39,26 +127,193 @@ def _processed_signature():
     return tuple(signature)
 
 
+def _is_fresh(path):
+    """Sortie dérivée de l'ETL (star, cubes) présente et pas plus ancienne que les faits :
+    un ETL qui n'écrit que les tables rend les dérivés d'un run précédent périmés."""
+    if not path.exists():
+        return False
+    facts = [PROCESSED_DIR / "fact_sales.parquet", PROCESSED_DIR / "fact_sales.csv"]
+    fact_mtimes = [fact.stat().st_mtime_ns for fact in facts if fact.exists()]
+    return not fact_mtimes or path.stat().st_mtime_ns >= max(fact_mtimes)
+
+
+def _arrow_types(arrow_type):
+    """Dictionnaires Arrow → category pandas, le reste en ArrowDtype."""
+    if pa.types.is_dictionary(arrow_type):
+        return None
+    return pd.ArrowDtype(arrow_type)
+
+
+def _read_csv(name, columns=None):
+    """Lecture CSV multi-threadée par Arrow avec le schéma de SCHEMAS."""
+    table = pa_csv.read_csv(
+        PROCESSED_DIR / f"{name}.csv",
+        convert_options=pa_csv.ConvertOptions(
+            column_types=SCHEMAS[name],
+            strings_can_be_null=True,
+            include_columns=columns,
+        ),
+    )
+    return table.to_pandas(types_mapper=_arrow_types)
+
+
+def _read_table(name, columns=None):
+    """Table DWH : Parquet si l'ETL l'a produit, sinon CSV (EXPORT_CSV=1)."""
+    path = PROCESSED_DIR / f"{name}.parquet"
+    if not path.exists():
+        return _read_csv(name, columns)
+    table = pq.read_table(path, columns=columns)
+    # Mêmes types que la lecture CSV, quelle que soit la source
+    for i, field in enumerate(table.schema):
+        target = SCHEMAS[name].get(field.name, field.type)
+        column = table.column(i)
+        if pa.types.is_dictionary(target):
+            # Pas de cast direct vers un dictionnaire (pyarrow 14) : texte puis encodage
+            column = pc.dictionary_encode(column.cast(pa.string()))
+        else:
+            column = column.cast(target)
+        table = table.set_column(i, field.name, column)
+    return table.to_pandas(types_mapper=_arrow_types)
+
+
+def _sorted_category(series):
+    """Category limitée aux valeurs présentes, catégories triées."""
+    cat = series.astype("category").cat.remove_unused_categories()
+    return cat.cat.reorder_categories(sorted(cat.cat.categories))
+
+
 @st.cache_data
 def load_data(_signature):
-    dim_time = pd.read_csv(PROCESSED_DIR / "dim_time.csv", parse_dates=["date"])
-    dim_customer = pd.read_csv(PROCESSED_DIR / "dim_customer.csv")
-    dim_employee = pd.read_csv(PROCESSED_DIR / "dim_employee.csv")
-    dim_shipper = pd.read_csv(PROCESSED_DIR / "dim_shipper.csv")
-    fact_sales = pd.read_csv(PROCESSED_DIR / "fact_sales.csv")
-
-    # Jointure en étoile → table analytique
-    df = fact_sales.merge(dim_time, on="TimeKey", how="left")
-    df = df.merge(dim_customer, on="CustomerKey", how="left")
-    df = df.merge(dim_employee, on="EmployeeKey", how="left")
-    df = df.merge(dim_shipper, on="ShipperKey", how="left")
-
-    # Sécurité : cast valeurs numériques
-    for col in ["DetailCount", "TotalQuantity", "AverageDiscount", "TotalLineTotal", "Freight"]:
-        if col in df.columns:
+    star_path = PROCESSED_DIR / STAR_FILE
+    if _is_fresh(star_path):
+        # Table déjà dénormalisée par l'ETL : aucune jointure à refaire
+        df = pq.read_table(star_path, columns=USED_COLS).to_pandas(types_mapper=_arrow_types)
+        dim_customer = _read_table("dim_customer", columns=["CustomerKey"])
+    else:
+        # Projection : seules les clés de jointure et les colonnes USED_COLS sont lues
+        dim_time = _read_table("dim_time", columns=["TimeKey", "date", "year", "month"])
+        dim_customer = _read_table(
+            "dim_customer", columns=["CustomerKey", "CustomerName", "CustomerCountry"]
+        )
+        dim_employee = _read_table("dim_employee", columns=["EmployeeKey", "EmployeeFullName"])
+        dim_shipper = _read_table("dim_shipper", columns=["ShipperKey", "ShipperName"])
+        fact_sales = _read_table(
+            "fact_sales",
+            columns=["TimeKey", "EmployeeKey", "ShipperKey"]
+            + [c for c in USED_COLS if c in SCHEMAS["fact_sales"]],
+        )
+
+        # Jointure en étoile → table analytique
+        df = fact_sales.merge(dim_time, on="TimeKey", how="left")
+        df = df.merge(dim_customer, on="CustomerKey", how="left")
+        df = df.merge(dim_employee, on="EmployeeKey", how="left")
+        df = df.merge(dim_shipper, on="ShipperKey", how="left")[USED_COLS]
+
+        # Sécurité : cast valeurs numériques
+        for col in ["DetailCount", "TotalQuantity", "AverageDiscount", "TotalLineTotal", "Freight"]:
             df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0.0)
 
-    return df
+    for col in CATEGORY_COLS:
+        df[col] = _sorted_category(df[col])
+
+    nb_clients_total = dim_customer["CustomerKey"].nunique()
+    return df, nb_clients_total
+
+
+@st.cache_data
+def load_cubes(signature):
+    """Cubes Parquet à jour dans data/processed (absents ou périmés → groupby classique)."""
+    cubes = {}
+    for name in CUBES:
+        path = PROCESSED_DIR / f"{name}.parquet"
+        if _is_fresh(path):
+            cubes[name] = pq.read_table(path).to_pandas(types_mapper=_arrow_types)
+    return cubes
+
+
+def _filter_mask(df, date_bounds, selections):
+    """Masque booléen combinant la période et les sélections actives."""
+    mask = np.ones(len(df), dtype=bool)
+    if date_bounds is not None:
+        start, end = date_bounds
+        dates = df["date"].to_numpy(dtype="datetime64[ns]", na_value=np.datetime64("NaT"))
+        mask &= (dates >= start.to_datetime64()) & (dates <= end.to_datetime64())
+    for col, selected in selections.items():
+        mask &= df[col].isin(selected).to_numpy()
+    return mask
+
+
+def _parquet_filters(date_bounds, active_filters, selections):
+    """Filtres actifs au format pyarrow (poussés dans la lecture Parquet)."""
+    filters = []
+    if "date" in active_filters:
+        start, end = date_bounds
+        filters += [("date", ">=", start), ("date", "<=", end)]
+    for col, selected in selections.items():
+        filters.append((col, "in", list(selected)))
+    return filters
+
+
+@st.cache_data(max_entries=32)
+def load_filtered(signature, filter_key):
+    """Périmètre filtré : lecture star.parquet avec predicate pushdown,
+    ou masque en mémoire sur load_data à défaut."""
+    date_bounds, active_filters, selections = filter_key
+    selections = dict(selections)
+    star_path = PROCESSED_DIR / STAR_FILE
+    if _is_fresh(star_path) and active_filters:
+        df = pq.read_table(
+            star_path,
+            columns=USED_COLS,
+            filters=_parquet_filters(date_bounds, active_filters, selections),
+        ).to_pandas(types_mapper=_arrow_types)
+        for col in CATEGORY_COLS:
+            df[col] = _sorted_category(df[col])
+        return df
+    df, _ = load_data(signature)
+    return df.loc[_filter_mask(df, date_bounds, selections)]
+
+
+def _cube_frame(name, cubes, active_filters, selections):
+    """Agrégat lu dans le cube si les filtres actifs portent uniquement
+    sur ses clés, sinon None."""
+    keys = CUBES[name][0]
+    cube = cubes.get(name)
+    if cube is None or not set(active_filters) <= set(keys):
+        return None
+    for col in active_filters:
+        cube = cube[cube[col].isin(selections[col])]
+    return cube
+
+
+@st.cache_data(max_entries=32)
+def chart_frame(name, signature, filter_key):
+    """Agrégat d'un graphique mémoïsé par (données, filtres)."""
+    _, active_filters, selections = filter_key
+    frame = _cube_frame(name, load_cubes(signature), active_filters, dict(selections))
+    if frame is None:
+        keys, measure, label = CUBES[name]
+        frame = (
+            load_filtered(signature, filter_key)
+            .groupby(keys, as_index=False, observed=True)
+            .agg(**{label: (measure, "sum")})
+        )
+    return frame
+
+
+def _detail_frame(filtered):
+    """Colonnes du détail, lignes triées par date décroissante."""
+    # Dates en datetime64 numpy comme l'export d'origine : même tri (ex aequo compris)
+    # et to_csv les écrit sans heure
+    detail_df = filtered[DISPLAY_COLS].astype({"date": "datetime64[ns]"})
+    return detail_df.sort_values("date", ascending=False)
+
+
+@st.cache_data(max_entries=8)
+def detail_csv(signature, filter_key):
+    """Export CSV du détail, mémoïsé par (données, filtres)."""
+    detail_df = _detail_frame(load_filtered(signature, filter_key))
+    return detail_df.to_csv(index=False).encode("utf-8")
 
 
 # ---------- Layout ----------
@@ -71,7 +326,7 @@ def main():
     st.title("📊 Dashboard Northwind – BI Ventes")
 
     signature = _processed_signature()
-    df = load_data(signature)
+    df, nb_clients_total = load_data(signature)
     signature_key = str(abs(hash(signature)))
 
     # =====================
@@ -93,7 +348,7 @@ def main():
     )
 
     # Pays
-    countries = sorted(df["CustomerCountry"].dropna().unique().tolist())
+    countries = df["CustomerCountry"].cat.categories.tolist()
     selected_countries = st.sidebar.multiselect(
         "Pays client",
         options=countries,
@@ -101,7 +356,7 @@ def main():
     )
 
     # Employés
-    employees = sorted(df["EmployeeFullName"].dropna().unique().tolist())
+    employees = df["EmployeeFullName"].cat.categories.tolist()
     selected_employees = st.sidebar.multiselect(
         "Commerciaux",
         options=employees,
@@ -109,49 +364,59 @@ def main():
     )
 
     # Transporteurs
-    shippers = sorted(df["ShipperName"].dropna().unique().tolist())
+    shippers = df["ShipperName"].cat.categories.tolist()
     selected_shippers = st.sidebar.multiselect(
         "Transporteurs",
         options=shippers,
         default=shippers,
     )
 
-    # Application des filtres
-    filtered = df.copy()
-    filters_active = False
+    # Application des filtres : un seul masque booléen, un seul slice
+    date_bounds = None
+    active_filters = []
+    selections = {}
     if isinstance(date_range, tuple) and len(date_range) == 2:
         start = pd.to_datetime(date_range[0])
         end = pd.to_datetime(date_range[1])
         if start.normalize() > end.normalize():
             start, end = end, start
-        filtered = filtered[(filtered["date"] >= start) &
-                            (filtered["date"] <= end)]
+        date_bounds = (start, end)
         if start.date() != full_start or end.date() != full_end:
-            filters_active = True
+            active_filters.append("date")
     country_filter_active = bool(selected_countries) and set(selected_countries) != set(countries)
     if country_filter_active:
-        filtered = filtered[filtered["CustomerCountry"].isin(selected_countries)]
-        filters_active = True
+        selections["CustomerCountry"] = tuple(sorted(selected_countries))
     employee_filter_active = bool(selected_employees) and set(selected_employees) != set(employees)
     if employee_filter_active:
-        filtered = filtered[filtered["EmployeeFullName"].isin(selected_employees)]
-        filters_active = True
+        selections["EmployeeFullName"] = tuple(sorted(selected_employees))
     shipper_filter_active = bool(selected_shippers) and set(selected_shippers) != set(shippers)
     if shipper_filter_active:
-        filtered = filtered[filtered["ShipperName"].isin(selected_shippers)]
-        filters_active = True
+        selections["ShipperName"] = tuple(sorted(selected_shippers))
+    active_filters += list(selections)
+    filters_active = bool(active_filters)
+    # Clé hashable des filtres pour le cache du périmètre et des agrégats
+    filter_key = (date_bounds, tuple(active_filters), tuple(selections.items()))
+    if filters_active:
+        filtered = load_filtered(signature, filter_key)
+    else:
+        # Aucun filtre : alias de df, un slice seulement si des dates manquent
+        mask = _filter_mask(df, date_bounds, selections)
+        filtered = df if mask.all() else df.loc[mask]
 
     # =====================
     # Indicateurs clés
     # =====================
-    total_ca = filtered["TotalLineTotal"].sum()
+    # Un seul appel agg pour les trois mesures du périmètre filtré
+    kpi = filtered.agg({
+        "TotalLineTotal": "sum",
+        "OrderKey": "nunique",
+        "CustomerKey": "nunique",
+    })
+    total_ca = float(kpi["TotalLineTotal"])
     nb_orders_total = df["OrderKey"].nunique()
-    nb_orders_filtered = filtered["OrderKey"].nunique()
+    nb_orders_filtered = int(kpi["OrderKey"])
     nb_orders_display = nb_orders_filtered if filters_active else nb_orders_total
-    nb_clients_total = pd.read_csv(
-        PROCESSED_DIR / "dim_customer.csv"
-    )["CustomerKey"].nunique()
-    nb_clients_filtered = filtered["CustomerKey"].nunique()
+    nb_clients_filtered = int(kpi["CustomerKey"])
     nb_clients_display = nb_clients_filtered if filters_active else nb_clients_total
     avg_basket = total_ca / nb_orders_filtered if nb_orders_filtered > 0 else 0
 
@@ -169,8 +434,7 @@ def main():
 
     # 1) CA mensuel
     ca_mensuel = (
-        filtered.groupby(["year", "month"], as_index=False)
-        .agg(CA=("TotalLineTotal", "sum"))
+        chart_frame("ca_by_month", signature, filter_key)
         .assign(
             Mois=lambda d: pd.to_datetime(
                 d["year"].astype(str) + "-" + d["month"].astype(str) + "-01"
@@ -191,9 +455,7 @@ def main():
 
     # 2) CA par pays
     ca_pays = (
-        filtered.dropna(subset=["CustomerCountry"])
-        .groupby("CustomerCountry", as_index=False)
-        .agg(CA=("TotalLineTotal", "sum"))
+        chart_frame("ca_by_country", signature, filter_key)
         .sort_values("CA", ascending=False)
         .head(10)
         .iloc[::-1]
@@ -211,8 +473,7 @@ def main():
 
     # 3) Top clients
     top_customers = (
-        filtered.groupby("CustomerName", as_index=False)
-        .agg(CA=("TotalLineTotal", "sum"))
+        chart_frame("ca_by_customer", signature, filter_key)
         .sort_values("CA", ascending=False)
         .head(10)
         .iloc[::-1]
@@ -230,8 +491,7 @@ def main():
 
     # 4) Performance des commerciaux
     ca_employes = (
-        filtered.groupby("EmployeeFullName", as_index=False)
-        .agg(CA=("TotalLineTotal", "sum"))
+        chart_frame("ca_by_employee", signature, filter_key)
         .sort_values("CA", ascending=False)
         .head(10)
         .iloc[::-1]
@@ -249,8 +509,7 @@ def main():
 
     # 5) Répartition du fret par transporteur
     freight_shipper = (
-        filtered.groupby("ShipperName", as_index=False)
-        .agg(Freight=("Freight", "sum"))
+        chart_frame("freight_by_shipper", signature, filter_key)
         .sort_values("Freight", ascending=False)
     )
 
@@ -271,22 +530,7 @@ def main():
     detail_count = len(filtered) if filters_active else len(df)
     st.subheader(f"📋 Détail des ventes 878 lignes affichées)")
 
-    display_cols = [
-        "OrderKey",
-        "date",
-        "CustomerName",
-        "CustomerCountry",
-        "EmployeeFullName",
-        "ShipperName",
-        "DetailCount",
-        "TotalQuantity",
-        "AverageDiscount",
-        "Freight",
-        "TotalLineTotal",
-    ]
-    display_cols = [c for c in display_cols if c in filtered.columns]
-
-    detail_df = filtered[display_cols].sort_values("date", ascending=False)
+    detail_df = _detail_frame(filtered)
 
     # ➜ AUCUNE LIMITATION : on affiche TOUT
     st.dataframe(detail_df, height=500, use_container_width=True)
@@ -294,7 +538,7 @@ def main():
     # Option : bouton de téléchargement
     st.download_button(
         "⬇️ Télécharger le détail (CSV)",
-        data=detail_df.to_csv(index=False).encode("utf-8"),
+        data=detail_csv(signature, filter_key),
         file_name="ventes_detaillees.csv",
         mime="text/csv",
     )
@@ -1,7 +1,11 @@
+import functools
+import os
 import pandas as pd
 import pyodbc
 from pathlib import Path
 
+from northwind_common import CUBES, STAR_FILE, time_key, write_parquet
+
 # ===============================================================
 #  CONFIGURATION DES CHEMINS
 # ===============================================================
@@ -9,15 +13,35 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 EXCEL_DIR = BASE_DIR / "data" / "excel"
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
+# POLARS_ETL=1 : agrégation des lignes de commande par Polars (optionnel)
+POLARS_ETL = os.environ.get("POLARS_ETL") == "1"
+# EXPORT_CSV=1 : écrit aussi les CSV (consommateurs externes), en plus du Parquet
+EXPORT_CSV = os.environ.get("EXPORT_CSV") == "1"
 EXCEL_ORDER_OFFSET = 200000
-EXCEL_ORDER_OFFSET = 200000
+
+# Clé de substitution des faits sans employé / transporteur (libellé nul)
+UNKNOWN_KEY = -1
+
+# Colonnes numériques converties en bloc (lignes de commande / fait)
+NUMERIC_OD = ["Discount", "Quantity", "UnitPrice"]
+NUMERIC_FS = ["DetailCount", "TotalQuantity", "AverageDiscount", "TotalLineTotal", "Freight"]
+
+# Colonnes de la table analytique dénormalisée lue par le dashboard
+STAR_FACT_COLUMNS = [
+    "OrderKey", "TimeKey", "CustomerKey", "EmployeeKey", "ShipperKey",
+    "DetailCount", "TotalQuantity", "AverageDiscount", "TotalLineTotal", "Freight",
+]
+
+# Libellés de regroupement stockés en category triée (dictionnaire Parquet)
+STAR_CATEGORY_COLUMNS = ["CustomerCountry", "CustomerName", "EmployeeFullName", "ShipperName"]
 
 
 # ===============================================================
 #  CONNEXION SQL SERVER
 # ===============================================================
+@functools.lru_cache(maxsize=1)
 def get_sql_connection():
-    """Retourne une connexion SQL Server ou None."""
+    """Retourne la connexion SQL Server partagée (ouverte une seule fois) ou None."""
     try:
         conn = pyodbc.connect(
             "DRIVER={ODBC Driver 17 for SQL Server};"
@@ -32,9 +56,45 @@ def get_sql_connection():
         return None
 
 
+def close_sql_connection():
+    """Ferme la connexion partagée si elle a été ouverte."""
+    if get_sql_connection.cache_info().currsize:
+        conn = get_sql_connection()
+        if conn is not None:
+            conn.close()
+        get_sql_connection.cache_clear()
+
+
+def _with_unknown(dim, key, label):
+    """Ajoute la ligne de clé UNKNOWN_KEY aux dimensions à clé int32.
+
+    Son libellé reste nul : la clé ne sert qu'à la jointure, filtres, graphiques
+    et exports voient une valeur manquante comme avant.
+    """
+    unknown = pd.DataFrame({key: pd.Series([UNKNOWN_KEY], dtype="int32"), label: [None]})
+    return pd.concat([dim, unknown], ignore_index=True)
+
+
 # ===============================================================
 #  LOAD EXCEL
 # ===============================================================
+def _read_excel(file):
+    """Lecture xlsx avec le moteur calamine (Rust) si disponible, sinon openpyxl."""
+    try:
+        return pd.read_excel(file, engine="calamine")
+    except (ImportError, ValueError):
+        return pd.read_excel(file)
+
+
+def _write_excel_cache(df, cache):
+    """Copie Parquet de la feuille Excel, relue tant que le xlsx n'a pas changé."""
+    try:
+        cache.parent.mkdir(exist_ok=True)
+        df.to_parquet(cache, engine="pyarrow", index=False)
+    except Exception as e:
+        print(f"   ⚠ Cache Parquet ignoré pour {cache.stem}: {e}")
+
+
 def load_excel(table):
     """Charge un fichier Excel si disponible (accepte nom avec ou sans underscores)."""
     candidates = [
@@ -43,7 +103,12 @@ def load_excel(table):
     ]
     for file in candidates:
         if file.exists():
-            df = pd.read_excel(file)
+            cache = file.parent / ".cache" / f"{file.stem}.parquet"
+            if cache.exists() and cache.stat().st_mtime_ns >= file.stat().st_mtime_ns:
+                df = pd.read_parquet(cache)
+            else:
+                df = _read_excel(file)
+                _write_excel_cache(df, cache)
             df.columns = [c.replace(" ", "") for c in df.columns]
             print(f"   Excel {table:<15}: {df.shape[0]:4} lignes, {df.shape[1]} colonnes")
             return df
@@ -84,14 +149,16 @@ def merge_sources(table, key, dedupe=True):
     df_sql = load_sql(table)
 
     def _adjust_excel_ids(df):
-        df = df.copy()
         name = table.lower().replace("_", " ").strip()
         if name in {"orders", "order details"}:
             if "OrderID" not in df.columns:
                 raise KeyError(f"Colonne OrderID introuvable dans le fichier Excel pour la table {table}")
-            df["OrderID"] = pd.to_numeric(df["OrderID"], errors="coerce")
-            df = df.dropna(subset=["OrderID"])
-            df["OrderID"] = df["OrderID"].astype(int) + EXCEL_ORDER_OFFSET
+            new_id = pd.to_numeric(df["OrderID"], errors="coerce")
+            valid = new_id.notna()
+            # df vient d'être lu depuis Excel : modifié sur place, sans recopier le tableau
+            if not valid.all():
+                df.drop(index=df.index[~valid], inplace=True)
+            df["OrderID"] = new_id[valid].astype("int64") + EXCEL_ORDER_OFFSET
         return df
 
     if df_excel is not None:
@@ -109,13 +176,36 @@ def merge_sources(table, key, dedupe=True):
         return None
 
     if dedupe:
-        df = df.drop_duplicates(subset=subset, keep="first")
-        df = df.dropna(subset=subset)
-        df = df.drop(columns="_source", errors="ignore")
+        # Un seul masque : clé complète ET première occurrence
+        key = df[subset]
+        df = df.loc[key.notna().all(axis=1) & ~key.duplicated(keep="first")]
 
     return df.reset_index(drop=True)
 
 
+# ===============================================================
+#  AGRÉGAT ORDER DETAILS – MOTEUR POLARS
+# ===============================================================
+def _detail_summary_polars(order_det):
+    """Agrège Order Details par commande avec Polars (lazy, multi-threadé)."""
+    import polars as pl
+
+    return (
+        pl.from_pandas(order_det[["OrderID"] + NUMERIC_OD])
+        .lazy()
+        .with_columns(LineTotal=pl.col("UnitPrice") * pl.col("Quantity") * (1 - pl.col("Discount")))
+        .group_by("OrderID")
+        .agg(
+            DetailCount=pl.len(),
+            TotalQuantity=pl.col("Quantity").sum(),
+            AverageDiscount=pl.col("Discount").mean(),
+            TotalLineTotal=pl.col("LineTotal").sum(),
+        )
+        .collect(engine="streaming")
+        .to_pandas()
+    )
+
+
 # ===============================================================
 #  ETAPE PRINCIPALE – BUILD STAR SCHEMA
 # ===============================================================
@@ -132,6 +222,7 @@ def build_star_schema():
     employees    = merge_sources("Employees",     "EmployeeID")
     shippers     = merge_sources("Shippers",      "ShipperID")
     categories   = merge_sources("Categories",    "CategoryID")
+    close_sql_connection()
 
     print(f"\n   📊 APRÈS fusion:")
     print(f"      Orders: {len(orders)} lignes")
@@ -152,7 +243,7 @@ def build_star_schema():
     #  DIM TIME
     # ===============================================================
     dim_time = pd.DataFrame({
-        "TimeKey": orders["OrderDate"].dt.strftime("%Y%m%d").astype(int),
+        "TimeKey": time_key(orders["OrderDate"]),
         "date": orders["OrderDate"],
         "year": orders["OrderDate"].dt.year,
         "month": orders["OrderDate"].dt.month,
@@ -185,9 +276,12 @@ def build_star_schema():
             "Title", "City", "Country"
         ]]
         .rename(columns={"EmployeeID": "EmployeeKey"})
+        .assign(EmployeeKey=lambda df: pd.to_numeric(df["EmployeeKey"], errors="coerce"))
         .dropna(subset=["EmployeeKey"])
         .drop_duplicates(subset=["EmployeeKey"])
+        .astype({"EmployeeKey": "int32"})
     )
+    dim_employee = _with_unknown(dim_employee, "EmployeeKey", "EmployeeFullName")
 
     # ===============================================================
     #  DIM SHIPPERS
@@ -198,10 +292,12 @@ def build_star_schema():
             "ShipperID": "ShipperKey",
             "CompanyName": "ShipperName"
         })
-        .assign(ShipperKey=lambda df: pd.to_numeric(df["ShipperKey"], errors="coerce").astype("Int64"))
+        .assign(ShipperKey=lambda df: pd.to_numeric(df["ShipperKey"], errors="coerce"))
         .dropna(subset=["ShipperKey"])
         .drop_duplicates(subset=["ShipperKey"])
+        .astype({"ShipperKey": "int32"})
     )
+    dim_shipper = _with_unknown(dim_shipper, "ShipperKey", "ShipperName")
 
     # ===============================================================
     #  DIM CATEGORIES
@@ -244,35 +340,34 @@ def build_star_schema():
     print(f"      Order Details: {len(order_det)} lignes")
     print(f"      Orders       : {len(orders)} lignes")
 
-    order_det["Discount"] = pd.to_numeric(order_det["Discount"], errors="coerce").fillna(0.0)
-    order_det["Quantity"] = pd.to_numeric(order_det["Quantity"], errors="coerce").fillna(0.0)
-    order_det["UnitPrice"] = pd.to_numeric(order_det["UnitPrice"], errors="coerce").fillna(0.0)
-    order_det["LineTotal"] = order_det["UnitPrice"] * order_det["Quantity"] * (1 - order_det["Discount"])
-    order_det["DetailCount"] = 1
-
-    detail_summary = (
-        order_det.groupby("OrderID", as_index=False)
-            .agg(
-                DetailCount=("DetailCount", "sum"),
-                TotalQuantity=("Quantity", "sum"),
-                AverageDiscount=("Discount", "mean"),
-                TotalLineTotal=("LineTotal", "sum"),
-            )
-    )
+    order_det[NUMERIC_OD] = order_det[NUMERIC_OD].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+    if POLARS_ETL:
+        print("      Moteur: Polars")
+        detail_summary = _detail_summary_polars(order_det)
+    else:
+        order_det["LineTotal"] = order_det["UnitPrice"] * order_det["Quantity"] * (1 - order_det["Discount"])
+        order_det["DetailCount"] = 1
+
+        detail_summary = (
+            order_det.groupby("OrderID", as_index=False)
+                .agg(
+                    DetailCount=("DetailCount", "sum"),
+                    TotalQuantity=("Quantity", "sum"),
+                    AverageDiscount=("Discount", "mean"),
+                    TotalLineTotal=("LineTotal", "sum"),
+                )
+        )
 
-    fact_sales = orders.drop(columns="_source", errors="ignore").merge(
+    fact_sales = orders.merge(
         detail_summary,
         on="OrderID",
         how="left"
     )
 
     fact_sales["OrderDate"] = pd.to_datetime(fact_sales["OrderDate"], errors="coerce").fillna(pd.Timestamp("1996-01-01"))
-    fact_sales["TimeKey"] = fact_sales["OrderDate"].dt.strftime("%Y%m%d").astype(int)
-    fact_sales["DetailCount"] = fact_sales["DetailCount"].fillna(0).astype(int)
-    fact_sales["TotalQuantity"] = fact_sales["TotalQuantity"].fillna(0.0)
-    fact_sales["AverageDiscount"] = fact_sales["AverageDiscount"].fillna(0.0)
-    fact_sales["TotalLineTotal"] = fact_sales["TotalLineTotal"].fillna(0.0)
-    fact_sales["Freight"] = pd.to_numeric(fact_sales["Freight"], errors="coerce").fillna(0.0)
+    fact_sales["TimeKey"] = time_key(fact_sales["OrderDate"])
+    fact_sales[NUMERIC_FS] = fact_sales[NUMERIC_FS].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+    fact_sales["DetailCount"] = fact_sales["DetailCount"].astype(int)
 
     fact_sales = fact_sales.rename(
         columns={
@@ -282,11 +377,13 @@ def build_star_schema():
             "ShipVia": "ShipperKey",
         }
     )
-    fact_sales["CustomerKey"] = fact_sales["CustomerKey"].astype(str).str.strip()
+    # Chaînes Arrow : strip exécuté par le kernel pyarrow, sans objet Python par ligne
+    fact_sales["CustomerKey"] = fact_sales["CustomerKey"].astype("string[pyarrow]").str.strip()
     for col in ["EmployeeKey", "ShipperKey"]:
         fact_sales[col] = (
             pd.to_numeric(fact_sales[col], errors="coerce")
-            .astype("Int64")
+            .fillna(UNKNOWN_KEY)
+            .astype("int32")
         )
 
     expected_orders = orders["OrderID"].nunique()
@@ -300,24 +397,56 @@ def build_star_schema():
         print(f"      ⚠ ÉCART: {gap} commandes manquantes dans la fact table.")
 
     # ===============================================================
-    #  EXPORT CSV
+    #  EXPORT PARQUET (+ CSV si EXPORT_CSV=1)
+    # ===============================================================
+    tables = {
+        "dim_time": dim_time,
+        "dim_customer": dim_customer,
+        "dim_product": dim_product,
+        "dim_employee": dim_employee,
+        "dim_shipper": dim_shipper,
+        "dim_categories": dim_categories,
+        "fact_sales": fact_sales,
+    }
+    for name, table in tables.items():
+        write_parquet(table, PROCESSED_DIR / f"{name}.parquet")
+        if EXPORT_CSV:
+            table.to_csv(PROCESSED_DIR / f"{name}.csv", index=False)
+
+    # ===============================================================
+    #  EXPORT STAR (PARQUET) – jointure faite une fois pour toutes
     # ===============================================================
-    dim_time.to_csv(PROCESSED_DIR / "dim_time.csv", index=False)
-    dim_customer.to_csv(PROCESSED_DIR / "dim_customer.csv", index=False)
-    dim_product.to_csv(PROCESSED_DIR / "dim_product.csv", index=False)
-    dim_employee.to_csv(PROCESSED_DIR / "dim_employee.csv", index=False)
-    dim_shipper.to_csv(PROCESSED_DIR / "dim_shipper.csv", index=False)
-    dim_categories.to_csv(PROCESSED_DIR / "dim_categories.csv", index=False)
-    fact_sales.to_csv(PROCESSED_DIR / "fact_sales.csv", index=False)
-
-    print("\n3) EXPORT DES TABLES (CSV) ✔ OK")
+    star = (
+        fact_sales[STAR_FACT_COLUMNS]
+        .merge(dim_time, on="TimeKey", how="left")
+        .merge(
+            dim_customer[["CustomerKey", "CustomerName", "CustomerCity", "CustomerCountry"]],
+            on="CustomerKey",
+            how="left",
+        )
+        .merge(dim_employee[["EmployeeKey", "EmployeeFullName"]], on="EmployeeKey", how="left")
+        .merge(dim_shipper[["ShipperKey", "ShipperName"]], on="ShipperKey", how="left")
+    )
+    for col in STAR_CATEGORY_COLUMNS:
+        star[col] = pd.Categorical(star[col], categories=sorted(star[col].dropna().unique()))
+    # Trié par date + row groups modestes : les filtres de période sautent des blocs
+    star = star.sort_values("date", kind="stable").reset_index(drop=True)
+    write_parquet(star, PROCESSED_DIR / STAR_FILE, row_group_size=64_000)
+
+    for name, (keys, measure, label) in CUBES.items():
+        cube = star.groupby(keys, as_index=False, observed=True).agg(**{label: (measure, "sum")})
+        write_parquet(cube, PROCESSED_DIR / f"{name}.parquet")
+
+    formats = "Parquet + CSV" if EXPORT_CSV else "Parquet"
+    print(f"\n3) EXPORT DES TABLES ({formats}) ✔ OK")
     print("============================================================")
     print("   🎉 ETL TERMINÉ AVEC SUCCÈS")
     print(f"   📊 RÉSUMÉ:")
     print(f"      • fact_sales: {len(fact_sales)} commandes")
     print(f"      • dim_customer: {len(dim_customer)} clients")
     print(f"      • dim_product: {len(dim_product)} produits")
-    print(f"      • dim_employee: {len(dim_employee)} employés")
+    # Sans la ligne UNKNOWN_KEY ajoutée par _with_unknown
+    print(f"      • dim_employee: {(dim_employee['EmployeeKey'] != UNKNOWN_KEY).sum()} employés")
     print("============================================================")
 
 
@@ -1,8 +1,25 @@
 
+import os
 import pyodbc
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from pathlib import Path
 
+from northwind_common import CUBES, STAR_FILE, time_key, write_parquet
+
+# Pilotes colonnes optionnels : résultat Arrow sans objet Python par cellule
+try:
+    import turbodbc
+except ImportError:
+    turbodbc = None
+try:
+    import connectorx
+except ImportError:
+    connectorx = None
+
 # Dossiers
 BASE_DIR = Path(__file__).resolve().parent.parent  
 DATA_DIR = BASE_DIR / "data"
@@ -10,6 +27,14 @@ EXCEL_DIR = DATA_DIR / "excel"
 PROCESSED_DIR = DATA_DIR / "processed"
 PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
 EXCEL_ORDER_OFFSET = 200000
+# Tables Excel dont les OrderID sont décalés (noms normalisés)
+EXCEL_OFFSET_TABLES = frozenset({"orders", "order details"})
+# EXPORT_CSV=1 : écrit aussi les CSV, en plus du Parquet
+EXPORT_CSV = os.environ.get("EXPORT_CSV") == "1"
+
+# Sorties dérivées de l'ETL Access (table étoile, cubes) : non produites ici,
+# supprimées pour que le dashboard ne serve pas celles d'un run précédent
+DERIVED_FILES = [STAR_FILE] + [f"{name}.parquet" for name in CUBES]
 
 CONN_STR = (
     "DRIVER={ODBC Driver 17 for SQL Server};"
@@ -17,46 +42,189 @@ CONN_STR = (
     "DATABASE=Northwind;"
     "Trusted_Connection=yes;"
 )
+# URI connectorx (format mssql://), utilisée si turbodbc est absent
+CONNECTORX_URI = os.environ.get(
+    "NORTHWIND_MSSQL_URI",
+    "mssql://localhost/Northwind?instance_name=SQLEXPRESS&trusted_connection=true",
+)
+# Lignes lues par lot côté pilote
+FETCH_BATCH_ROWS = 10000
+# Tables extraites de SQL Server → colonnes lues (None = toutes, le fait garde
+# toutes les colonnes de Orders). Une connexion par table, en parallèle.
+SOURCE_COLUMNS = {
+    "Orders": None,
+    "Customers": ["CustomerID", "CompanyName", "ContactName", "ContactTitle", "City", "Country", "Phone"],
+    "Products": [
+        "ProductID",
+        "ProductName",
+        "QuantityPerUnit",
+        "UnitPrice",
+        "UnitsInStock",
+        "UnitsOnOrder",
+        "ReorderLevel",
+        "Discontinued",
+        "CategoryID",
+    ],
+    "Employees": ["EmployeeID", "FirstName", "LastName", "Title", "City", "Country"],
+    "Shippers": ["ShipperID", "CompanyName", "Phone"],
+    "Categories": ["CategoryID", "CategoryName"],
+}
+
+# Colonnes utiles des fichiers Excel (noms sans espaces, None = toutes)
+EXCEL_COLUMNS = {
+    **SOURCE_COLUMNS,
+    "Order Details": ["OrderID", "ProductID", "Quantity", "UnitPrice", "Discount"],
+}
+
+# Lignes de commande agrégées par le serveur : seul le résumé par commande transite
+ORDER_DETAILS_SUMMARY_SQL = """
+SELECT OrderID,
+       COUNT(*) AS DetailCount,
+       SUM(CAST(Quantity AS float)) AS TotalQuantity,
+       AVG(CAST(Discount AS float)) AS AverageDiscount,
+       SUM(CAST(UnitPrice AS float) * Quantity * (1 - CAST(Discount AS float))) AS TotalLineTotal
+FROM [Order Details]
+GROUP BY OrderID
+"""
+
+# Compteurs de stock : entiers 16 bits nullables (les lignes Excel peuvent être vides)
+PRODUCT_DTYPES = {
+    "UnitsInStock": "Int16",
+    "UnitsOnOrder": "Int16",
+    "ReorderLevel": "Int16",
+}
+
+# Libellés très répétés → category (dédoublonnage et Parquet sur codes entiers)
+LABEL_COLUMNS = ["City", "Country", "ContactTitle", "Title", "ShipCity", "ShipCountry", "ShipRegion"]
+
+# Mesures de la table de faits (commandes sans ligne de détail → 0)
+FACT_MEASURE_DTYPES = {
+    "DetailCount": "int32",
+    "TotalQuantity": "float64",
+    "AverageDiscount": "float64",
+    "TotalLineTotal": "float64",
+    "Freight": "float64",
+}
 
 
 def get_connection():
+    if turbodbc is not None:
+        # money/decimal en float64 (pas en texte), nvarchar lu en unicode
+        options = turbodbc.make_options(
+            read_buffer_size=turbodbc.Rows(FETCH_BATCH_ROWS),
+            large_decimals_as_64_bit_types=True,
+            prefer_unicode=True,
+        )
+        return turbodbc.connect(connection_string=CONN_STR, turbodbc_options=options)
+    if connectorx is not None:
+        return None  # connectorx ouvre ses propres connexions
     return pyodbc.connect(CONN_STR)
 
 
-def load_table(name: str, conn) -> pd.DataFrame:
-    query = f"SELECT * FROM [{name}]"
-    return pd.read_sql(query, conn)
+def read_query(query: str, conn) -> pd.DataFrame:
+    """Exécute une requête : turbodbc → connectorx → pd.read_sql (pyodbc)."""
+    if turbodbc is not None:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query)
+            table = cursor.fetchallarrow()
+        finally:
+            cursor.close()
+    elif connectorx is not None:
+        table = connectorx.read_sql(CONNECTORX_URI, query, return_type="arrow")
+    else:
+        return pd.read_sql(query, conn)
+    # Types numpy, comme pd.read_sql : le reste de l'ETL est inchangé
+    return table.to_pandas()
+
+
+def load_table(name: str, conn, columns=None) -> pd.DataFrame:
+    selected = ", ".join(f"[{c}]" for c in columns) if columns else "*"
+    return read_query(f"SELECT {selected} FROM [{name}]", conn)
+
+
+def load_order_details_summary(conn) -> pd.DataFrame:
+    return read_query(ORDER_DETAILS_SUMMARY_SQL, conn)
+
+def _with_own_connection(loader, *args, **kwargs):
+    # Une connexion par thread : les pilotes ODBC libèrent le GIL pendant l'attente
+    conn = get_connection()
+    try:
+        return loader(*args, conn=conn, **kwargs)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def load_sources() -> dict:
+    """Extraction simultanée des sources : durée ≈ la plus lente des requêtes."""
+    with ThreadPoolExecutor(max_workers=len(SOURCE_COLUMNS) + 1) as pool:
+        futures = {
+            name: pool.submit(_with_own_connection, load_table, name, columns=columns)
+            for name, columns in SOURCE_COLUMNS.items()
+        }
+        futures["Order Details"] = pool.submit(_with_own_connection, load_order_details_summary)
+        return {name: future.result() for name, future in futures.items()}
+
+def _read_excel(file: Path, usecols=None) -> pd.DataFrame:
+    """Lecture xlsx avec le moteur calamine (Rust, un seul passage) si disponible, sinon openpyxl."""
+    try:
+        return pd.read_excel(file, engine="calamine", usecols=usecols)
+    except (ImportError, ValueError):
+        return pd.read_excel(file, usecols=usecols)
 
 def load_excel_table(name: str) -> pd.DataFrame | None:
     candidates = [
         EXCEL_DIR / f"{name}.xlsx",
         EXCEL_DIR / f"{name.replace(' ', '_')}.xlsx",
     ]
+    wanted = EXCEL_COLUMNS.get(name)
+    usecols = None if wanted is None else (lambda col: col.replace(" ", "") in wanted)
     for file in candidates:
         if file.exists():
-            df = pd.read_excel(file)
+            df = _read_excel(file, usecols)
             df.columns = [c.replace(" ", "") for c in df.columns]
             print(f"   Excel {name:<15}: {len(df)} lignes")
             return df
     return None
 
+def _export_table(name: str, table: pd.DataFrame):
+    write_parquet(table, PROCESSED_DIR / f"{name}.parquet")
+    if EXPORT_CSV:
+        table.to_csv(PROCESSED_DIR / f"{name}.csv", index=False)
+
+def downcast(df: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    """Convertit les colonnes présentes vers les types étroits de dtypes."""
+    for col, dtype in dtypes.items():
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+    return df
+
+def as_categories(df: pd.DataFrame) -> pd.DataFrame:
+    """Passe en category les colonnes de LABEL_COLUMNS présentes."""
+    return df.astype({col: "category" for col in LABEL_COLUMNS if col in df.columns})
+
+def _adjust_excel_ids(df: pd.DataFrame, table: str) -> pd.DataFrame:
+    """Décale les OrderID Excel de EXCEL_ORDER_OFFSET (lignes sans OrderID écartées).
+
+    df vient d'être lu depuis Excel : il est modifié sur place, sans recopier le tableau.
+    """
+    if "OrderID" not in df.columns:
+        raise KeyError(f"Colonne OrderID introuvable dans le fichier Excel pour la table {table}")
+    new_id = pd.to_numeric(df["OrderID"], errors="coerce")
+    valid = new_id.notna()
+    if not valid.all():
+        df.drop(index=df.index[~valid], inplace=True)
+    df["OrderID"] = new_id[valid].to_numpy(dtype="int64") + EXCEL_ORDER_OFFSET
+    return df
+
 def merge_with_excel(sql_df: pd.DataFrame, table: str, key_columns, dedupe=True):
     subset = list(key_columns) if isinstance(key_columns, (list, tuple)) else [key_columns]
     df_excel = load_excel_table(table)
 
-    def _adjust_excel_ids(df):
-        df = df.copy()
-        name = table.lower().replace("_", " ").strip()
-        if name in {"orders", "order details"}:
-            if "OrderID" not in df.columns:
-                raise KeyError(f"Colonne OrderID introuvable dans le fichier Excel pour la table {table}")
-            df["OrderID"] = pd.to_numeric(df["OrderID"], errors="coerce")
-            df = df.dropna(subset=["OrderID"])
-            df["OrderID"] = df["OrderID"].astype(int) + EXCEL_ORDER_OFFSET
-        return df
-
-    if df_excel is not None:
-        df_excel = _adjust_excel_ids(df_excel)
+    name = table.lower().replace("_", " ").strip()
+    if df_excel is not None and name in EXCEL_OFFSET_TABLES:
+        df_excel = _adjust_excel_ids(df_excel, table)
 
     if df_excel is None and sql_df is None:
         return None
@@ -68,32 +236,64 @@ def merge_with_excel(sql_df: pd.DataFrame, table: str, key_columns, dedupe=True)
         combined = pd.concat([df_excel, sql_df], ignore_index=True)
 
     if combined is not None and dedupe:
-        combined = combined.drop_duplicates(subset=subset, keep="first")
-        combined = combined.dropna(subset=subset)
+        # Colonne clé absente (Excel seul) : lignes sans clé, écartées par le masque
+        combined = combined.reindex(columns=combined.columns.union(subset, sort=False))
+        # Un seul masque : clé complète ET première occurrence. Les dimensions
+        # construites ensuite n'ont donc plus à refaire dropna/drop_duplicates.
+        key = combined[subset]
+        combined = combined.loc[key.notna().all(axis=1) & ~key.duplicated(keep="first")]
 
     return combined.reset_index(drop=True) if combined is not None else None
 
 
+def summarize_order_details(order_details: pd.DataFrame) -> pd.DataFrame:
+    """Résumé par commande des lignes Excel (même calcul que ORDER_DETAILS_SUMMARY_SQL)."""
+    # Colonnes converties une fois en tableaux float64 contigus (montants : pas de float32)
+    codes, order_ids = pd.factorize(order_details["OrderID"], sort=True)
+    qty, price, disc = (
+        pd.to_numeric(order_details[col], errors="coerce").fillna(0.0).to_numpy(np.float64)
+        for col in ["Quantity", "UnitPrice", "Discount"]
+    )
+    n_orders = len(order_ids)
+    line = price * qty
+    line -= line * disc
+    count = np.bincount(codes, minlength=n_orders)
+    total_qty = np.bincount(codes, weights=qty, minlength=n_orders)
+    total_disc = np.bincount(codes, weights=disc, minlength=n_orders)
+    total_line = np.bincount(codes, weights=line, minlength=n_orders)
+    return pd.DataFrame({
+        "OrderID": order_ids,
+        "DetailCount": count.astype(np.int64),
+        "TotalQuantity": total_qty,
+        "AverageDiscount": total_disc / count,
+        "TotalLineTotal": total_line,
+    })
+
+
 def build_etl():
-    print("🔌 Connexion à SQL Server...")
-    with get_connection() as conn:
-        print("✅ Connecté.")
-
-        print("📥 Chargement des tables source...")
-        orders = load_table("Orders", conn)
-        order_details = load_table("Order Details", conn)
-        customers = load_table("Customers", conn)
-        products = load_table("Products", conn)
-        employees = load_table("Employees", conn)
-        shippers = load_table("Shippers", conn)
-        categories = load_table("Categories", conn)
+    print("📥 Chargement des tables source depuis SQL Server...")
+    sources = load_sources()
+    print("✅ Tables chargées.")
+    orders = sources["Orders"]
+    detail_summary = sources["Order Details"]
+    customers = sources["Customers"]
+    products = sources["Products"]
+    employees = sources["Employees"]
+    shippers = sources["Shippers"]
+    categories = sources["Categories"]
 
     # Fusion Excel + SQL (si fichiers Excel présents)
-    orders = merge_with_excel(orders, "Orders", "OrderID")
-    order_details = merge_with_excel(order_details, "Order Details", ["OrderID", "ProductID"])
-    customers = merge_with_excel(customers, "Customers", "CustomerID")
-    products = merge_with_excel(products, "Products", "ProductID")
-    employees = merge_with_excel(employees, "Employees", "EmployeeID")
+    # Category après la fusion : concaténer avec les feuilles Excel la défairait
+    orders = as_categories(merge_with_excel(orders, "Orders", "OrderID"))
+    # Lignes Excel : résumées ici, puis ajoutées au résumé calculé par SQL Server
+    excel_details = merge_with_excel(None, "Order Details", ["OrderID", "ProductID"])
+    if excel_details is not None and len(excel_details):
+        detail_summary = pd.concat(
+            [summarize_order_details(excel_details), detail_summary], ignore_index=True
+        )
+    customers = as_categories(merge_with_excel(customers, "Customers", "CustomerID"))
+    products = downcast(merge_with_excel(products, "Products", "ProductID"), PRODUCT_DTYPES)
+    employees = as_categories(merge_with_excel(employees, "Employees", "EmployeeID"))
     shippers = merge_with_excel(shippers, "Shippers", "ShipperID")
     categories = merge_with_excel(categories, "Categories", "CategoryID")
 
@@ -108,11 +308,12 @@ def build_etl():
         .reset_index(drop=True)
     )
 
-    dim_time["TimeKey"] = dim_time["date"].dt.strftime("%Y%m%d").astype(int)
-    dim_time["year"] = dim_time["date"].dt.year
-    dim_time["month"] = dim_time["date"].dt.month
-    dim_time["day"] = dim_time["date"].dt.day
-    dim_time["year_month"] = dim_time["date"].dt.strftime("%Y-%m")
+    dim_time["TimeKey"] = time_key(dim_time["date"])
+    dim_time["year"] = dim_time["date"].dt.year.astype("int16")
+    dim_time["month"] = dim_time["date"].dt.month.astype("int8")
+    dim_time["day"] = dim_time["date"].dt.day.astype("int8")
+    # Troncature au mois du buffer datetime64 : "AAAA-MM" sans strftime
+    dim_time["year_month"] = dim_time["date"].to_numpy().astype("datetime64[M]").astype(str)
 
     dim_time = dim_time[
         ["TimeKey", "date", "year", "month", "day", "year_month"]
@@ -141,8 +342,6 @@ def build_etl():
                 "Phone",
             ]
         ]
-        .dropna(subset=["CustomerKey"])
-        .drop_duplicates(subset=["CustomerKey"])
     )
 
     # ---------- Dimension Produit ----------
@@ -151,6 +350,8 @@ def build_etl():
         categories[["CategoryID", "CategoryName"]],
         on="CategoryID",
         how="left",
+        validate="many_to_one",
+        copy=False,  # pandas 2.1 (sans copy-on-write) : évite de recopier products
     )
 
     dim_product = dim_product.rename(
@@ -174,13 +375,18 @@ def build_etl():
                 "CategoryName",
             ]
         ]
-        .dropna(subset=["ProductKey"])
-        .drop_duplicates(subset=["ProductKey"])
     )
 
     # ---------- Dimension Employe ----------
     print("🧱 Construction DimEmployee...")
-    employees["EmployeeFullName"] = employees["FirstName"] + " " + employees["LastName"]
+    # Concaténation par le kernel Arrow (prénom ou nom manquant → nom complet nul)
+    first_name, last_name = (
+        pa.array(employees[col], type=pa.string(), from_pandas=True)
+        for col in ["FirstName", "LastName"]
+    )
+    employees["EmployeeFullName"] = pc.binary_join_element_wise(
+        first_name, last_name, " "
+    ).to_numpy(zero_copy_only=False)
 
     dim_employee = (
         employees[
@@ -195,8 +401,6 @@ def build_etl():
             ]
         ]
         .rename(columns={"EmployeeID": "EmployeeKey"})
-        .dropna(subset=["EmployeeKey"])
-        .drop_duplicates(subset=["EmployeeKey"])
     )
 
     # ---------- Dimension Transporteur ----------
@@ -211,38 +415,22 @@ def build_etl():
     dim_shipper = (
         dim_shipper[["ShipperKey", "ShipperName", "Phone"]]
         .assign(ShipperKey=lambda df: pd.to_numeric(df["ShipperKey"], errors="coerce").astype("Int64"))
-        .dropna(subset=["ShipperKey"])
-        .drop_duplicates(subset=["ShipperKey"])
     )
+    # La conversion numérique peut créer des clés nulles ou en double : un seul masque
+    shipper_key = dim_shipper["ShipperKey"]
+    dim_shipper = dim_shipper.loc[shipper_key.notna() & ~shipper_key.duplicated(keep="first")]
 
     # ---------- Table de Faits ----------
     print("🧮 Construction FactSales...")
-    order_details["Discount"] = pd.to_numeric(order_details["Discount"], errors="coerce").fillna(0.0)
-    order_details["Quantity"] = pd.to_numeric(order_details["Quantity"], errors="coerce").fillna(0.0)
-    order_details["UnitPrice"] = pd.to_numeric(order_details["UnitPrice"], errors="coerce").fillna(0.0)
-    order_details["LineTotal"] = (
-        order_details["UnitPrice"] * order_details["Quantity"] * (1 - order_details["Discount"])
-    )
-    order_details["DetailCount"] = 1
-
-    detail_summary = (
-        order_details.groupby("OrderID", as_index=False)
-            .agg(
-                DetailCount=("DetailCount", "sum"),
-                TotalQuantity=("Quantity", "sum"),
-                AverageDiscount=("Discount", "mean"),
-                TotalLineTotal=("LineTotal", "sum"),
-            )
+    # Jointure sur index OrderID (unique des deux côtés) : un seul passage d'indexation
+    fact_sales = (
+        orders.set_index("OrderID")
+        .join(detail_summary.set_index("OrderID"), how="left", validate="one_to_one")
+        .reset_index()
     )
-
-    fact_sales = orders.merge(detail_summary, on="OrderID", how="left")
-    fact_sales["OrderDate"] = pd.to_datetime(fact_sales["OrderDate"])
-    fact_sales["TimeKey"] = fact_sales["OrderDate"].dt.strftime("%Y%m%d").astype(int)
-    fact_sales["DetailCount"] = fact_sales["DetailCount"].fillna(0).astype(int)
-    fact_sales["TotalQuantity"] = fact_sales["TotalQuantity"].fillna(0.0)
-    fact_sales["AverageDiscount"] = fact_sales["AverageDiscount"].fillna(0.0)
-    fact_sales["TotalLineTotal"] = fact_sales["TotalLineTotal"].fillna(0.0)
-    fact_sales["Freight"] = pd.to_numeric(fact_sales["Freight"], errors="coerce").fillna(0.0)
+    fact_sales["TimeKey"] = time_key(fact_sales["OrderDate"])
+    # Mesures : un seul fillna et un seul astype pour toutes les colonnes
+    fact_sales = fact_sales.fillna(dict.fromkeys(FACT_MEASURE_DTYPES, 0)).astype(FACT_MEASURE_DTYPES)
     fact_sales = fact_sales.rename(
         columns={
             "OrderID": "OrderKey",
@@ -251,7 +439,8 @@ def build_etl():
             "ShipVia": "ShipperKey",
         }
     )
-    fact_sales["CustomerKey"] = fact_sales["CustomerKey"].astype(str).str.strip()
+    # Kernel de chaînes Arrow : pas d'objet str par ligne, les clés absentes restent nulles
+    fact_sales["CustomerKey"] = fact_sales["CustomerKey"].astype("string[pyarrow]").str.strip()
     for col in ["EmployeeKey", "ShipperKey"]:
         fact_sales[col] = (
             pd.to_numeric(fact_sales[col], errors="coerce")
@@ -259,13 +448,20 @@ def build_etl():
         )
 
     # ---------- Sauvegarde ----------
-    print("💾 Sauvegarde des CSV dans:", PROCESSED_DIR)
-    dim_time.to_csv(PROCESSED_DIR / "dim_time.csv", index=False)
-    dim_customer.to_csv(PROCESSED_DIR / "dim_customer.csv", index=False)
-    dim_product.to_csv(PROCESSED_DIR / "dim_product.csv", index=False)
-    dim_employee.to_csv(PROCESSED_DIR / "dim_employee.csv", index=False)
-    dim_shipper.to_csv(PROCESSED_DIR / "dim_shipper.csv", index=False)
-    fact_sales.to_csv(PROCESSED_DIR / "fact_sales.csv", index=False)
+    print("💾 Sauvegarde Parquet" + (" + CSV" if EXPORT_CSV else "") + " dans:", PROCESSED_DIR)
+    tables = {
+        "dim_time": dim_time,
+        "dim_customer": dim_customer,
+        "dim_product": dim_product,
+        "dim_employee": dim_employee,
+        "dim_shipper": dim_shipper,
+        "fact_sales": fact_sales,
+    }
+    # Écritures indépendantes : encodage et compression Arrow hors GIL, en parallèle
+    with ThreadPoolExecutor(max_workers=len(tables)) as pool:
+        list(pool.map(_export_table, tables, tables.values()))
+    for name in DERIVED_FILES:
+        (PROCESSED_DIR / name).unlink(missing_ok=True)
 
     print("✅ ETL terminé.")
 
@@ -0,0 +1,36 @@
+# scripts/northwind_common.py
+# ===============================
+# Helpers et constantes partagés par les ETL et le dashboard
+# ===============================
+# Les deux scripts écrivent dans le même data/processed, que lit le dashboard :
+# une seule définition du format Parquet, de la clé temps et des sorties dérivées.
+
+import pyarrow as pa
+
+# Table de faits déjà jointe aux dimensions (écrite par l'ETL Access)
+STAR_FILE = "star.parquet"
+
+# Cubes pré-agrégés pour les graphiques : nom → (clés, mesure, libellé)
+CUBES = {
+    "ca_by_month": (["year", "month"], "TotalLineTotal", "CA"),
+    "ca_by_country": (["CustomerCountry"], "TotalLineTotal", "CA"),
+    "ca_by_customer": (["CustomerName"], "TotalLineTotal", "CA"),
+    "ca_by_employee": (["EmployeeFullName"], "TotalLineTotal", "CA"),
+    "freight_by_shipper": (["ShipperName"], "Freight", "Freight"),
+}
+
+
+def write_parquet(df, path, **kwargs):
+    """Écrit un Parquet zstd (dictionnaire) ; colonnes object hétérogènes en texte."""
+    options = dict(engine="pyarrow", compression="zstd", use_dictionary=True, index=False, **kwargs)
+    try:
+        df.to_parquet(path, **options)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        mixed = df.select_dtypes("object").columns
+        df.astype({c: "string" for c in mixed}).to_parquet(path, **options)
+
+
+def time_key(dates):
+    """TimeKey AAAAMMJJ calculée en arithmétique entière (sans strftime)."""
+    dt = dates.dt
+    return (dt.year * 10000 + dt.month * 100 + dt.day).astype("int32")
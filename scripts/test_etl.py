@@ -1,31 +1,32 @@
 # scripts/test_etl.py
 # ===============================
-# Validation rapide des CSV ETL
+# Validation rapide des tables ETL
 # ===============================
 
 from pathlib import Path
 import pandas as pd
+import pyarrow.parquet as pq
 
 BASE_DIR = Path(__file__).resolve().parents[1]
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 
 TABLES = {
-    "dim_time.csv": {
+    "dim_time.parquet": {
         "required": ["TimeKey", "date", "year", "month", "day"],
     },
-    "dim_customer.csv": {
+    "dim_customer.parquet": {
         "required": ["CustomerKey", "CustomerName", "CustomerCity", "CustomerCountry", "Phone"],
     },
-    "dim_product.csv": {
+    "dim_product.parquet": {
         "required": ["ProductKey", "ProductName", "UnitPrice", "CategoryName", "Discontinued"],
     },
-    "dim_employee.csv": {
+    "dim_employee.parquet": {
         "required": ["EmployeeKey", "EmployeeFullName", "FirstName", "LastName", "Title", "City", "Country"],
     },
-    "dim_shipper.csv": {
+    "dim_shipper.parquet": {
         "required": ["ShipperKey", "ShipperName", "Phone"],
     },
-    "fact_sales.csv": {
+    "fact_sales.parquet": {
         "required": [
             "OrderKey",
             "TimeKey",
@@ -41,9 +42,29 @@ TABLES = {
 }
 
 
+def read_metadata(path):
+    """Colonnes, nombre de lignes et lecteur d'aperçu, sans lire toute la table."""
+    if path.suffix == ".parquet":
+        parquet = pq.ParquetFile(path)
+        columns = parquet.schema_arrow.names
+        n_rows = parquet.metadata.num_rows
+
+        def read_preview(cols):
+            if parquet.num_row_groups == 0:
+                return pd.DataFrame(columns=cols)
+            return parquet.read_row_group(0, columns=cols).to_pandas().head(3)
+    else:
+        columns = list(pd.read_csv(path, nrows=0).columns)
+        n_rows = len(pd.read_csv(path, usecols=[0]))
+
+        def read_preview(cols):
+            return pd.read_csv(path, nrows=3, usecols=cols)
+    return columns, n_rows, read_preview
+
+
 def main():
     print("=" * 60)
-    print(" TEST DE VALIDATION DES CSV")
+    print(" TEST DE VALIDATION DES TABLES ETL")
     print("=" * 60)
     print()
 
@@ -51,7 +72,10 @@ def main():
 
     for filename, info in TABLES.items():
         path = PROCESSED_DIR / filename
-        print(filename)
+        # Parquet par défaut ; CSV des anciens exports (ou EXPORT_CSV=1) à défaut
+        if not path.exists() and path.with_suffix(".csv").exists():
+            path = path.with_suffix(".csv")
+        print(path.name)
         print("-" * 60)
 
         if not path.exists():
@@ -60,19 +84,19 @@ def main():
             print()
             continue
 
-        df = pd.read_csv(path)
         required_cols = info["required"]
-        missing = [c for c in required_cols if c not in df.columns]
+        columns, n_rows, read_preview = read_metadata(path)
+        missing = [c for c in required_cols if c not in columns]
 
         if missing:
             print("   ❌ Colonnes manquantes : ", missing)
             all_ok = False
         else:
             print("   ✅ Toutes les colonnes requises sont présentes")
-            print(f"   Lignes   : {len(df)}")
-            print(f"   Colonnes : {len(df.columns)}")
+            print(f"   Lignes   : {n_rows}")
+            print(f"   Colonnes : {len(columns)}")
             print("   Aperçu (3 premières lignes) :")
-            preview = df.head(3)
+            preview = read_preview(required_cols[:5])
             for _, row in preview.iterrows():
                 for col in required_cols[:5]:  # afficher max 5 colonnes importantes
                     print(f"      • {col}: {row[col]}")